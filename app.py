@@ -1,13 +1,37 @@
 import os
+import gzip
 import json
+import time
+import hashlib
+import itertools
+import functools
+import tempfile
 import shlex
+import shutil
+import signal
 import subprocess
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Request, render_template, request, redirect, url_for, send_file, flash
 
 # ---------- CONFIG ----------
 UPLOAD_FOLDER = "uploads"
 CMD_TIMEOUT = 25  # per-tool timeout
+MAX_TOOL_WORKERS = 8  # tools run concurrently per request
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, ".cache")
+CACHE_TTL = 24 * 3600  # seconds a cached tool result stays valid
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024  # 1 GB
+UPLOAD_SPOOL_SIZE = 64 * 1024  # uploads larger than this go straight to a temp file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+REPORT_GZIP_LEVEL = 5  # reports are also stored pre-gzipped for clients that accept it
+REPORT_WORKERS = 2  # background threads writing JSON reports
+REPORT_WAIT = 10  # seconds a download waits for a report that is still being written
+REPORT_SUFFIX = "_analysis.json"
+MAX_OUTPUT_BYTES = 2 * 1024 * 1024  # stdout kept per tool; the tool is killed past this
+# tighter caps for tools that can dump huge output we only skim
+OUTPUT_LIMITS = {
+    "strings": 64 * 1024,
+}
 SAMPLE_FILE_PATH = "/mnt/data/A_digital_photograph_displays_a_daytime_landscape_.png"
 
 # Tools we will actually run (safe CLI tools). If not installed, results show 'binary-not-found'
@@ -43,12 +67,35 @@ TOOL_COMMANDS = {
     "file": ["file", "-k", "{file}"],
 }
 
+# Tools whose stderr is actually used (by compute_suspicion_score); everything else goes to /dev/null
+NEEDS_STDERR = {"ffprobe", "mediainfo"}
+
+# Tools whose output depends only on the file's bytes, not on its path, name or
+# filesystem metadata; their cached results are shared by every upload of the same bytes.
+# Other tools (exiftool, file, objdump, ffprobe, ...) echo the path or timestamps, so
+# theirs are only reused for the same file on disk.
+PATH_INDEPENDENT_TOOLS = {"strings", "binwalk", "readelf", "pdfinfo", "pdfimages", "qpdf", "docx2txt", "tshark"}
+
+# Absolute path of each tool binary, resolved once at startup (None if not installed)
+RESOLVED = {name: shutil.which(cmd[0]) for name, cmd in TOOL_COMMANDS.items()}
+
+# Argument lists with "{file}" swapped for a sentinel, so building a command is a plain
+# identity check per argument instead of str.format
+FILE_SENTINEL = object()
+ARG_TEMPLATES = {
+    name: [FILE_SENTINEL if part == "{file}" else part for part in cmd[1:]]
+    for name, cmd in TOOL_COMMANDS.items()
+}
+
 # Tools we show as info only (not executed)
 DANGEROUS_TOOLS = [
     "autopsy", "sleuthkit", "blkid", "lsblk", "dumpe2fs", "mmls", "fsstat", "istat",
     "tcpdump (root)", "pdftk (may require extra packages)", "metadata-cleaner (GUI)", "exiftool-gui"
 ]
 
+# Keywords in `strings` output that add to the suspicion score
+SUSPICIOUS_KEYWORDS = ["password", "secret", "key=", "private key", "-----begin"]
+
 IMAGE_TOOLS = ["exiftool", "exiv2", "identify", "mat2", "strings", "binwalk"]
 VIDEO_TOOLS = ["ffprobe", "mediainfo"]
 BINARY_TOOLS = ["readelf", "objdump", "rabin2", "strings", "file"]
@@ -56,75 +103,286 @@ DOC_TOOLS = ["pdfinfo", "pdfimages", "docx2txt", "qpdf", "mutool"]
 NETWORK_TOOLS = ["tshark"]
 
 # ---------- APP ----------
+class UploadRequest(Request):
+    # werkzeug keeps uploads up to 500 KB in memory; spool file parts to disk much earlier.
+    # (max_form_memory_size is left alone: werkzeug applies it to its parse buffer for
+    # every part, so lowering it rejects ordinary large uploads with 413)
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode="rb+")
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
 app.secret_key = "change-me-for-prod"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# reports are written off the request path; downloads poll for them (see wait_for_report)
+REPORT_POOL = ThreadPoolExecutor(max_workers=REPORT_WORKERS)
+UPLOAD_COUNTER = itertools.count(1)  # suffixes for colliding upload names
+
 # ---------- Helpers ----------
-def safe_run(cmd_list, timeout=CMD_TIMEOUT):
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def safe_run(cmd_list, timeout=CMD_TIMEOUT, max_bytes=MAX_OUTPUT_BYTES, capture_stderr=True):
     """
     Run command list (no shell). Returns dict with stdout, stderr, returncode, elapsed.
+    At most max_bytes of stdout are kept; if the tool writes more it is killed
+    and the result is marked truncated. With capture_stderr=False stderr is
+    discarded: the result has no "stderr" key and is marked stderr_discarded.
     """
+    cmd_str = " ".join(shlex.quote(x) for x in cmd_list)
+    # stderr goes to a temp file so a chatty tool can't block on a pipe we aren't reading
+    err = tempfile.TemporaryFile() if capture_stderr else None
     try:
-        start = datetime.now()
-        proc = subprocess.run(cmd_list, capture_output=True, text=True, timeout=timeout)
-        end = datetime.now()
-        return {
-            "cmd": " ".join(shlex.quote(x) for x in cmd_list),
+        start = time.perf_counter()
+        # own session/process group, so a kill also reaches grandchildren (e.g. ImageMagick
+        # delegates) that would otherwise keep the stdout pipe open past the timeout
+        proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE,
+                                stderr=err if err is not None else subprocess.DEVNULL,
+                                start_new_session=True)
+        expired = threading.Event()
+        def on_timeout():
+            expired.set()
+            kill_process_group(proc)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.start()
+        try:
+            out = proc.stdout.read(max_bytes + 1)
+            truncated = len(out) > max_bytes
+            if truncated:
+                kill_process_group(proc)
+                out = out[:max_bytes]
+            proc.stdout.close()
+            proc.wait()
+        except BaseException:
+            kill_process_group(proc)
+            proc.wait()
+            raise
+        finally:
+            timer.cancel()
+        if expired.is_set():
+            return {"cmd": cmd_str, "error": "timeout"}
+        elapsed = time.perf_counter() - start
+        result = {
+            "cmd": cmd_str,
             "returncode": proc.returncode,
-            "stdout": proc.stdout.strip(),
-            "stderr": proc.stderr.strip(),
-            "elapsed": (end - start).total_seconds()
+            "stdout": out.decode("utf-8", errors="replace").rstrip(),
+            "elapsed": elapsed
         }
-    except subprocess.TimeoutExpired:
-        return {"cmd": " ".join(shlex.quote(x) for x in cmd_list), "error": "timeout"}
+        if err is not None:
+            err.seek(0)
+            result["stderr"] = err.read(max_bytes).decode("utf-8", errors="replace").rstrip()
+        else:
+            # don't report an empty stderr for output we never looked at
+            result["stderr_discarded"] = True
+        if truncated:
+            result["truncated"] = True
+        return result
     except FileNotFoundError:
-        return {"cmd": " ".join(shlex.quote(x) for x in cmd_list), "error": "binary-not-found"}
+        return {"cmd": cmd_str, "error": "binary-not-found"}
     except Exception as e:
-        return {"cmd": " ".join(shlex.quote(x) for x in cmd_list), "error": str(e)}
+        return {"cmd": cmd_str, "error": str(e)}
+    finally:
+        if err is not None:
+            err.close()
+
+@functools.lru_cache(maxsize=None)
+def get_orjson():
+    # imported on first report rather than at startup, so workers that only
+    # serve /ping and static pages never load it
+    try:
+        import orjson
+    except ImportError:  # optional, falls back to the stdlib json module
+        return None
+    return orjson
+
+def write_report(json_path, payload):
+    try:
+        orjson = get_orjson()
+        if orjson is not None:
+            data = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+        else:
+            # indentation is cosmetic for a download, and slow in pure Python
+            data = json.dumps(payload).encode("utf-8")
+        # write to a temp name and rename so a download never sees a half-written file;
+        # the .gz goes first so it is in place by the time the plain report appears
+        for path, content in ((json_path + ".gz", gzip.compress(data, REPORT_GZIP_LEVEL)), (json_path, data)):
+            # mkstemp: unique across threads and forked gunicorn workers alike
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                            dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as jf:
+                    jf.write(content)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+    except Exception:
+        # runs on REPORT_POOL, so nobody else would see this
+        app.logger.exception("Writing report %s failed", json_path)
+        raise
+
+def submit_report(json_path, payload):
+    REPORT_POOL.submit(write_report, json_path, payload)
+
+def wait_for_report(name, path):
+    """
+    The report may still be queued on REPORT_POOL, possibly in another gunicorn worker,
+    so poll the filesystem for a bounded time. Only names that belong to an analyzed
+    file are waited for; anything else fails fast.
+    """
+    if os.path.exists(path) or not name.endswith(REPORT_SUFFIX):
+        return os.path.exists(path)
+    source = name[:-len(REPORT_SUFFIX)]
+    if not (os.path.exists(os.path.join(app.config["UPLOAD_FOLDER"], source))
+            or source == os.path.basename(SAMPLE_FILE_PATH)):
+        return False
+    deadline = time.monotonic() + REPORT_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        if os.path.exists(path):
+            return True
+    return False
+
+def file_sha256(path, chunk_size=64 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def tool_options(tool):
+    return {"max_bytes": OUTPUT_LIMITS.get(tool, MAX_OUTPUT_BYTES), "capture_stderr": tool in NEEDS_STDERR}
 
-def run_tools_on_file(filepath, selected_tools):
+def _cache_path(tool, digest, key_cmd, opts):
+    # the command and run options are part of the key, so changing TOOL_COMMANDS,
+    # OUTPUT_LIMITS or NEEDS_STDERR invalidates old entries
+    key = f"{tool}:{digest}:{':'.join(key_cmd)}:{opts['max_bytes']}:{opts['capture_stderr']}"
+    name = f"{tool}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.json"
+    return os.path.join(CACHE_FOLDER, digest, name)
+
+def load_cached_result(path):
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def store_cached_result(path, result):
+    # timeouts and other failures may be transient, don't pin them
+    if "error" in result:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # temp file + rename, so a concurrent analysis of the same bytes never reads a partial entry
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(result, fh)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def run_tools_on_file(filepath, selected_tools, digest=None):
     results = {}
+    jobs = []
+    if digest:
+        # path-dependent output is only reused for this exact file as it is on disk now
+        st = os.stat(filepath)
+        file_key = [filepath, str(st.st_ino), str(st.st_mtime_ns)]
     for t in selected_tools:
         if t not in TOOL_COMMANDS:
             results[t] = {"error": "tool-not-configured"}
             continue
-        cmd_template = TOOL_COMMANDS[t]
-        cmd = [part.format(file=filepath) for part in cmd_template]
-        results[t] = safe_run(cmd)
-    return results
+        if RESOLVED[t] is None:
+            results[t] = {"cmd": TOOL_COMMANDS[t][0], "error": "binary-not-found"}
+            continue
+        cmd = [RESOLVED[t]] + [filepath if part is FILE_SENTINEL else part for part in ARG_TEMPLATES[t]]
+        opts = tool_options(t)
+        cache_path = None
+        if digest:
+            if t in PATH_INDEPENDENT_TOOLS:
+                key_cmd = [RESOLVED[t]] + TOOL_COMMANDS[t][1:]
+            else:
+                key_cmd = cmd + file_key
+            cache_path = _cache_path(t, digest, key_cmd, opts)
+            cached = load_cached_result(cache_path)
+            if cached is not None:
+                # may come from another upload of the same bytes
+                cached["cmd"] = " ".join(shlex.quote(x) for x in cmd)
+                cached["cached"] = True
+                results[t] = cached
+                continue
+        jobs.append((t, cmd, opts, cache_path))
+    if not jobs:
+        return {t: results[t] for t in selected_tools if t in results}
+
+    # tools are independent subprocesses, so run them side by side;
+    # each call still has its own CMD_TIMEOUT
+    with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_TOOL_WORKERS)) as pool:
+        futures = {pool.submit(safe_run, cmd, **opts): (t, cache_path) for t, cmd, opts, cache_path in jobs}
+        for fut in as_completed(futures):
+            t, cache_path = futures[fut]
+            results[t] = fut.result()
+            if cache_path:
+                store_cached_result(cache_path, results[t])
+    # keep the order the user selected the tools in
+    return {t: results[t] for t in selected_tools if t in results}
 
 def save_uploaded_file(file_storage):
     filename = os.path.basename(file_storage.filename)
     dest_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
     base, ext = os.path.splitext(filename)
-    i = 1
-    while os.path.exists(dest_path):
-        filename = f"{base}_{i}{ext}"
-        dest_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        i += 1
-    file_storage.save(dest_path)
-    return os.path.abspath(dest_path), filename
+    # O_EXCL makes claiming the name atomic, so concurrent uploads can't clobber each other;
+    # on collision take the next counter value rather than probing _1, _2, ... in turn
+    while True:
+        try:
+            fd = os.open(dest_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            break
+        except FileExistsError:
+            filename = f"{base}_{next(UPLOAD_COUNTER)}{ext}"
+            dest_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    # copy in fixed-size chunks and hash on the way through
+    h = hashlib.sha256()
+    with os.fdopen(fd, "wb") as out:
+        while chunk := file_storage.stream.read(UPLOAD_CHUNK_SIZE):
+            out.write(chunk)
+            h.update(chunk)
+    return os.path.abspath(dest_path), filename, h.hexdigest()
 
 # ---------- Suspicion scoring ----------
 def compute_suspicion_score(results, filename):
     score = 0
     reasons = []
+    fn_lower = filename.lower()
 
-    # file command mismatch
-    f_out = results.get("file", {})
-    if f_out and f_out.get("stdout"):
-        s = f_out.get("stdout").lower()
-        if "jpeg" in s and not filename.lower().endswith((".jpg", ".jpeg")):
+    # file command mismatch (file -k lists every match, so polyglots can hit several)
+    f_low = ((results.get("file") or {}).get("stdout") or "").lower()
+    if f_low:
+        if "jpeg" in f_low and not fn_lower.endswith((".jpg", ".jpeg")):
             score += 15; reasons.append("File type says JPEG but extension mismatch")
-        if "png" in s and not filename.lower().endswith(".png"):
+        if "png" in f_low and not fn_lower.endswith(".png"):
             score += 12; reasons.append("File type says PNG but extension mismatch")
-        if "pdf" in s and not filename.lower().endswith(".pdf"):
+        if "pdf" in f_low and not fn_lower.endswith(".pdf"):
             score += 14; reasons.append("File says PDF but extension mismatch")
 
     # strings analysis
-    s_out = results.get("strings", {}).get("stdout", "").lower()
+    s_out = ((results.get("strings") or {}).get("stdout") or "").lower()
     if s_out:
         # look in the first 800 chars for headers
         head = s_out[:800]
@@ -132,26 +390,27 @@ def compute_suspicion_score(results, filename):
             score += 25; reasons.append("Found 'MZ' header inside file — possible embedded PE")
         if "elf" in head:
             score += 22; reasons.append("Found 'ELF' inside file — possible embedded binary")
-        for kw in ["password", "secret", "key=", "private key", "-----begin"]:
+        # keywords count anywhere in the (capped) output
+        for kw in SUSPICIOUS_KEYWORDS:
             if kw in s_out:
                 score += 8; reasons.append(f"Found suspicious keyword: {kw}")
 
     # binwalk
-    bw = results.get("binwalk", {})
-    if bw and bw.get("stdout"):
-        out = bw.get("stdout").strip()
-        if out and len(out.splitlines()) > 2:
-            score += min(25, 5 + len(out.splitlines()))
-            reasons.append(f"Binwalk found embedded content ({len(out.splitlines())} lines)")
+    bw_out = ((results.get("binwalk") or {}).get("stdout") or "").strip()
+    if bw_out:
+        n = bw_out.count("\n") + 1
+        if n > 2:
+            score += min(25, 5 + n)
+            reasons.append(f"Binwalk found embedded content ({n} lines)")
 
     # ffprobe/mediainfo parse issues
-    ff = results.get("ffprobe", {}) or results.get("mediainfo", {})
+    ff = results.get("ffprobe") or results.get("mediainfo")
     if ff and ff.get("stderr"):
         score += 10; reasons.append("ffprobe/mediainfo reported errors parsing media")
 
     # readelf
-    re_out = results.get("readelf", {}).get("stdout", "")
-    if re_out and "ELF" in re_out:
+    re_out = (results.get("readelf") or {}).get("stdout") or ""
+    if "ELF" in re_out:
         score += 25; reasons.append("readelf reports ELF header inside file")
 
     score = max(0, min(100, score))
@@ -184,6 +443,7 @@ def analyze():
             flash("Sample file missing on server.", "danger")
             return redirect(url_for("index"))
         filename = os.path.basename(filepath)
+        digest = file_sha256(filepath)
     else:
         if "file" not in request.files:
             flash("No file uploaded.", "danger")
@@ -192,22 +452,21 @@ def analyze():
         if f.filename == "":
             flash("Empty filename.", "danger")
             return redirect(url_for("index"))
-        filepath, filename = save_uploaded_file(f)
+        filepath, filename, digest = save_uploaded_file(f)
 
-    results = run_tools_on_file(filepath, selected_tools)
+    results = run_tools_on_file(filepath, selected_tools, digest)
     score, verdict, reasons = compute_suspicion_score(results, filename)
 
     # Save JSON report
-    json_name = f"{filename}_analysis.json"
+    json_name = f"{filename}{REPORT_SUFFIX}"
     json_path = os.path.join(app.config["UPLOAD_FOLDER"], json_name)
-    with open(json_path, "w", encoding="utf-8") as jf:
-        json.dump({
-            "file": filename,
-            "score": score,
-            "verdict": verdict,
-            "reasons": reasons,
-            "results": results
-        }, jf, indent=2)
+    submit_report(json_path, {
+        "file": filename,
+        "score": score,
+        "verdict": verdict,
+        "reasons": reasons,
+        "results": results
+    })
 
     return render_template("results.html",
                            filename=filename,
@@ -220,14 +479,23 @@ def analyze():
 @app.route("/download/<path:name>")
 def download_json(name):
     path = os.path.join(app.config["UPLOAD_FOLDER"], name)
-    if not os.path.exists(path):
+    if not wait_for_report(name, path):
         flash("File not found.", "danger")
         return redirect(url_for("index"))
-    return send_file(path, as_attachment=True)
+    gz_path = path + ".gz"
+    if request.accept_encodings.quality("gzip") > 0 and os.path.exists(gz_path):
+        resp = send_file(gz_path, mimetype="application/json", as_attachment=True, download_name=name)
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.vary.add("Accept-Encoding")
+        return resp
+    resp = send_file(path, as_attachment=True)
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 @app.route("/ping")
 def ping():
     return "pong"
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0")
+    # development server only; production runs under gunicorn via wsgi.py
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host="0.0.0.0")
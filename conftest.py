@@ -0,0 +1 @@
+# keeps the repo root on sys.path so tests can import app
@@ -0,0 +1,21 @@
+import hashlib
+import io
+import os
+
+import app as app_module
+
+
+def test_large_upload_is_saved(tmp_path, monkeypatch):
+    # larger than UPLOAD_SPOOL_SIZE and werkzeug's 64 KB read chunk
+    payload = os.urandom(1024 * 1024)
+    monkeypatch.setitem(app_module.app.config, "UPLOAD_FOLDER", str(tmp_path))
+    data = {"file": (io.BytesIO(payload), "big.bin")}
+    with app_module.app.test_request_context("/analyze", method="POST", data=data,
+                                             content_type="multipart/form-data"):
+        f = app_module.request.files["file"]
+        path, filename, digest = app_module.save_uploaded_file(f)
+
+    assert filename == "big.bin"
+    assert digest == hashlib.sha256(payload).hexdigest()
+    with open(path, "rb") as fh:
+        assert fh.read() == payload
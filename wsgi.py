@@ -0,0 +1,6 @@
+# WSGI entry point, e.g.:
+#   gunicorn -w $(nproc) -k gthread --threads 8 --timeout 120 -b 0.0.0.0:5000 wsgi:app
+from app import app
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0")